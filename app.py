@@ -1,12 +1,19 @@
+import base64
+import functools
+import hashlib
+import hmac
 import os
 import threading
 import time
 
-from flask import Flask, jsonify, request, abort, g
-from flask_httpauth import HTTPBasicAuth
+from cachetools import TTLCache
+from flask import Flask, Response, json, jsonify, request, \
+    stream_with_context, abort, g
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 from flask_socketio import SocketIO
+import redis
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 
 import config
@@ -17,33 +24,83 @@ app = Flask(__name__)
 config_name = os.environ.get('FLASK_CONFIG', 'dev')
 app.config.from_object(getattr(config, config_name.title() + 'Config'))
 
-db = SQLAlchemy(app)
+# objects are not expired on commit, so that they can be serialized after a
+# commit without having to be reloaded from the database
+db = SQLAlchemy(app, session_options={'expire_on_commit': False})
 migrate = Migrate(app, db)
-basic_auth = HTTPBasicAuth()
 
 message_queue = 'redis://' + os.environ['REDIS'] if 'REDIS' in os.environ \
     else None
 if message_queue:
     socketio = SocketIO(message_queue=message_queue)
+    lock_client = redis.StrictRedis.from_url(message_queue)
 else:
     socketio = None
+    lock_client = None
+
+# seconds between passes of the background thread
+SWEEP_INTERVAL = 5
+
+# links included in exported users, formatted directly instead of going
+# through url_for, as lists of users would need a URL map lookup per user
+USER_URL = '/api/users/{}'
+MESSAGES_URL = '/api/messages/{}'
+
+# user pings are buffered here and written to the database in bulk by the
+# background thread, so that authenticated requests do not need to commit
+_ping_buffer = {}
+_ping_lock = threading.Lock()
+
+
+def buffer_ping(user_id):
+    """Record that a user was seen, to be written by the background thread."""
+    with _ping_lock:
+        _ping_buffer[user_id] = timestamp()
+
+
+# recently verified passwords, so that clients that poll with basic auth do
+# not need to go through the expensive password hash check every time
+_verified_passwords = TTLCache(maxsize=1024, ttl=60)
+_verified_passwords_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_password_hash(password_hash):
+    """Split a PBKDF2 password hash into its hash function, iterations,
+    salt and digest. Returns None for hashes in any other format."""
+    try:
+        method, salt, digest = password_hash.split('$', 2)
+        algorithm, hash_name, iterations = method.split(':')
+        if algorithm != 'pbkdf2':
+            return None
+        return (hash_name, int(iterations), salt.encode('utf-8'),
+                bytes.fromhex(digest))
+    except ValueError:
+        return None
+
+
+def check_password(password_hash, password):
+    """Check a password against a password hash."""
+    parsed_hash = parse_password_hash(password_hash)
+    if parsed_hash is None:
+        return check_password_hash(password_hash, password)
+    hash_name, iterations, salt, digest = parsed_hash
+    return hmac.compare_digest(digest, hashlib.pbkdf2_hmac(
+        hash_name, password.encode('utf-8'), salt, iterations))
 
 
-@basic_auth.verify_password
 def verify_password(nickname, password):
-    """Password verification callback."""
+    """Check the nickname and password given with basic auth."""
     if not nickname or not password:
         return False
     user = User.query.filter_by(nickname=nickname).first()
     if user is None or not user.verify_password(password):
         return False
-    user.ping()
-    db.session.commit()
+    buffer_ping(user.id)
     g.current_user = user
     return True
 
 
-@basic_auth.error_handler
 def password_error():
     """Return a 401 error to the client."""
     # To avoid login prompts in the browser, use the "Bearer" realm.
@@ -51,12 +108,42 @@ def password_error():
             {'WWW-Authenticate': 'Bearer realm="Authentication Required"'})
 
 
+def basic_auth_required(f):
+    """Decorator that requires basic auth with nickname and password.
+
+    The Authorization header is decoded directly, without going through the
+    generic handling of Flask-HTTPAuth, as clients poll this endpoint.
+    """
+    @functools.wraps(f)
+    def decorated(*args, **kwargs):
+        nickname = password = None
+        auth = request.headers.get('Authorization', '')
+        if auth[:6].lower() == 'basic ':
+            try:
+                credentials = base64.b64decode(auth[6:]).decode('utf-8')
+            except ValueError:
+                pass
+            else:
+                nickname, _, password = credentials.partition(':')
+        if not verify_password(nickname, password):
+            return password_error()
+        return f(*args, **kwargs)
+    return decorated
+
+
 class User(db.Model):
     """The User model."""
+    # Relationships added to this model must be declared with lazy='raise',
+    # with endpoints that need them opting in with subqueryload(), so that
+    # listing users can never fall into a query per user.
     __tablename__ = 'users'
+    __table_args__ = (
+        db.Index('ix_users_online_last_seen_at', 'online', 'last_seen_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.Integer, default=timestamp)
-    updated_at = db.Column(db.Integer, default=timestamp, onupdate=timestamp)
+    updated_at = db.Column(db.Integer, default=timestamp, onupdate=timestamp,
+                           index=True)
     last_seen_at = db.Column(db.Integer, default=timestamp)
     nickname = db.Column(db.String(32), nullable=False, unique=True)
     password_hash = db.Column(db.String(256), nullable=False)
@@ -68,10 +155,20 @@ class User(db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(
+            password, method=app.config['PASSWORD_HASH_METHOD'])
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        key = (self.password_hash,
+               hashlib.sha256(password.encode('utf-8')).hexdigest())
+        with _verified_passwords_lock:
+            if key in _verified_passwords:
+                return True
+        if not check_password(self.password_hash, password):
+            return False
+        with _verified_passwords_lock:
+            _verified_passwords[key] = True
+        return True
 
     def ping(self):
         """Marks the user as recently seen and online."""
@@ -96,29 +193,74 @@ class User(db.Model):
 
     def to_dict(self):
         """Export user to a dictionary."""
+        return User.export(self)
+
+    @staticmethod
+    def export(user):
+        """Export a user to a dictionary.
+
+        The user can be a model instance or a result row that has the
+        exported columns, which avoids loading full instances in lists.
+        """
         return {
-            'id': self.id,
-            'created_at': self.created_at,
-            'updated_at': self.updated_at,
-            'nickname': self.nickname,
-            'last_seen_at': self.last_seen_at,
-            'online': self.online,
+            'id': user.id,
+            'created_at': user.created_at,
+            'updated_at': user.updated_at,
+            'nickname': user.nickname,
+            'last_seen_at': user.last_seen_at,
+            'online': user.online,
             '_links': {
-                'self': url_for('get_user', id=self.id),
-                'messages': '/api/messages/{}'.format(self.id),
+                'self': USER_URL.format(user.id),
+                'messages': MESSAGES_URL.format(user.id),
                 'tokens': '/api/tokens'
             }
         }
 
+    @staticmethod
+    def flush_pings():
+        """Write buffered user pings to the database."""
+        with _ping_lock:
+            pings = _ping_buffer.copy()
+            _ping_buffer.clear()
+        if not pings:
+            return
+        ping_times = db.case(pings, value=User.id)
+        try:
+            # pings that are not newer than the last seen time are ignored,
+            # so that a ping buffered before a logout, possibly by another
+            # process, does not set the user back online
+            User.query.filter(User.id.in_(list(pings)),
+                              User.last_seen_at < ping_times).update(
+                {'last_seen_at': ping_times, 'online': True},
+                synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            # return the pings to the buffer for the next attempt, unless
+            # newer pings for the same users were recorded in the meantime
+            with _ping_lock:
+                for user_id, last_seen_at in pings.items():
+                    _ping_buffer.setdefault(user_id, last_seen_at)
+            raise
+        emit_user_updates(list(pings))
+
     @staticmethod
     def find_offline_users():
         """Find users that haven't been active and mark them as offline."""
         users = User.query.filter(User.last_seen_at < timestamp() - 60,
-                                  User.online == True).all()  # noqa
-        for user in users:
-            user.online = False
-            db.session.add(user)
+                                  User.online == True)  # noqa
+        ids = []
+        if socketio is not None:
+            ids = [row.id for row in users.with_entities(User.id)]
+            if not ids:
+                return
+        users.update({'online': False}, synchronize_session=False)
         db.session.commit()
+        emit_user_updates(ids)
+
+
+# columns needed to export users without loading model instances
+user_export_columns = [User.id, User.created_at, User.updated_at,
+                       User.nickname, User.last_seen_at, User.online]
 
 
 @db.event.listens_for(User, 'after_insert')
@@ -129,15 +271,74 @@ def after_user_update(mapper, connection, target):
                                         'model': target.to_dict()})
 
 
+def emit_user_updates(ids):
+    """Notify clients of users that were updated in bulk."""
+    if socketio is not None and ids:
+        query = db.select(user_export_columns).where(User.id.in_(ids))
+        for user in db.session.execute(query):
+            socketio.emit('updated_model', {'class': 'User',
+                                            'model': User.export(user)})
+
+
+def acquire_sweep_lock():
+    """Check if this process should look for offline users.
+
+    All the processes that run the service flush their own pings, but only
+    one of them needs to look for offline users on each interval. The Redis
+    lock expires before the next interval, so it does not need to be
+    released. When there is no Redis server this is the only process.
+    """
+    if lock_client is None:
+        return True
+    return bool(lock_client.set('microflack_users:sweep', os.getpid(),
+                                nx=True, px=SWEEP_INTERVAL * 1000 - 500))
+
+
+def users_list_query(online, updated_since):
+    """Build the query that returns the list of users, with bound
+    parameters for the requested filters."""
+    query = db.select(user_export_columns)
+    query = query.order_by(User.updated_at.asc(), User.nickname.asc())
+    if online:
+        query = query.where(User.online == db.bindparam('online'))
+    if updated_since:
+        query = query.where(User.updated_at >= db.bindparam('updated_since'))
+    return query
+
+
+# the list of users query is built once for each combination of filters, so
+# that its compiled form can be cached and reused across requests
+users_list_queries = {
+    (online, updated_since): users_list_query(online, updated_since)
+    for online in (False, True) for updated_since in (False, True)
+}
+users_list_compiled_cache = {}
+
+
+def run_background_pass():
+    """Write buffered pings, then look for offline users if this process
+    holds the sweep lock."""
+    User.flush_pings()
+    if acquire_sweep_lock():
+        User.find_offline_users()
+
+
 @app.before_first_request
 def before_first_request():
-    """Start a background thread that looks for users that leave."""
+    """Start a background thread that records user pings and looks for users
+    that leave."""
     def find_offline_users():
         with app.app_context():
             while True:
-                User.find_offline_users()
+                try:
+                    run_background_pass()
+                except Exception:
+                    # this thread is the only writer of user pings, so it
+                    # must survive database or Redis errors
+                    db.session.rollback()
+                    app.logger.exception('Background users task failed')
                 db.session.remove()
-                time.sleep(5)
+                time.sleep(SWEEP_INTERVAL)
 
     if not app.config['TESTING']:
         thread = threading.Thread(target=find_offline_users)
@@ -147,12 +348,9 @@ def before_first_request():
 @app.before_request
 def before_request():
     if hasattr(g, 'jwt_claims') and 'user_id' in g.jwt_claims:
-        user = User.query.get(g.jwt_claims['user_id'])
-        if user is None:
-            abort(500)
-        user.ping()
-        db.session.add(user)
-        db.session.commit()
+        # the token has been verified already, so there is no need to load
+        # the user here; pings for deleted users are ignored when flushed
+        buffer_ping(g.jwt_claims['user_id'])
 
 
 @app.route('/api/users', methods=['POST'])
@@ -162,10 +360,13 @@ def new_user():
     This endpoint is publicly available.
     """
     user = User.create(request.get_json() or {})
-    if User.query.filter_by(nickname=user.nickname).first() is not None:
-        abort(400)
     db.session.add(user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # the nickname is already in use
+        db.session.rollback()
+        abort(400)
     r = jsonify(user.to_dict())
     r.status_code = 201
     r.headers['Location'] = url_for('get_user', id=user.id)
@@ -180,13 +381,27 @@ def get_users():
     This endpoint is publicly available, but if the client has a token it
     should send it, as that indicates to the server that the user is online.
     """
-    users = User.query.order_by(User.updated_at.asc(), User.nickname.asc())
+    params = {}
     if request.args.get('online'):
-        users = users.filter_by(online=(request.args.get('online') != '0'))
+        params['online'] = request.args.get('online') != '0'
     if request.args.get('updated_since'):
-        users = users.filter(
-            User.updated_at >= int(request.args.get('updated_since')))
-    return jsonify({'users': [user.to_dict() for user in users.all()]})
+        params['updated_since'] = int(request.args.get('updated_since'))
+    query = users_list_queries[('online' in params,
+                                'updated_since' in params)]
+    conn = db.session.connection().execution_options(
+        compiled_cache=users_list_compiled_cache, stream_results=True)
+    users = conn.execute(query, params)
+
+    def generate():
+        # stream the response, so that the list of users is never fully
+        # loaded in memory
+        yield '{"users": ['
+        for i, user in enumerate(users):
+            yield (',' if i > 0 else '') + json.dumps(User.export(user))
+        yield ']}\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
 
 
 @app.route('/api/users/<int:id>', methods=['GET'])
@@ -218,7 +433,7 @@ def edit_user(id):
 
 
 @app.route('/api/users/me', methods=['GET'])
-@basic_auth.login_required
+@basic_auth_required
 def get_me_user():
     """
     Return the authenticated user.
@@ -242,8 +457,13 @@ def set_user_online():
 @token_auth.login_required
 def set_user_offline():
     """Set the user that owns the token offline."""
+    with _ping_lock:
+        _ping_buffer.pop(g.jwt_claims['user_id'], None)
     user = User.query.get(g.jwt_claims['user_id'])
     if user is not None:
+        # pings buffered before this point are older than the updated last
+        # seen time, so they will not set the user back online
+        user.last_seen_at = timestamp()
         user.online = False
         db.session.commit()
     return '', 204
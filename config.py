@@ -19,15 +19,31 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get(
         'DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'users.sqlite'))
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    if not SQLALCHEMY_DATABASE_URI.startswith('sqlite:'):
+        # keep a pool of warm connections, recycled before the server drops
+        # them for being idle
+        SQLALCHEMY_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 20))
+        SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+        SQLALCHEMY_POOL_RECYCLE = 1800
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD',
+                                          'pbkdf2:sha256:120000')
+    # indented output forces the json module to use its pure Python encoder
+    JSONIFY_PRETTYPRINT_REGULAR = False
 
 
 class DevConfig(Config):
     DEBUG = True
+    JSONIFY_PRETTYPRINT_REGULAR = True
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    # the in-memory database uses a single static connection
+    SQLALCHEMY_POOL_SIZE = None
+    SQLALCHEMY_MAX_OVERFLOW = None
+    SQLALCHEMY_POOL_RECYCLE = None
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
 
 
 class ProdConfig(Config):
@@ -6,24 +6,45 @@ import mock
 import time
 import unittest
 
+from werkzeug.security import generate_password_hash, check_password_hash
+
 from microflack_common.auth import generate_token
 from microflack_common.test import FlackTestCase
 
 import app
 app.socketio = mock.MagicMock()
-from app import app, db, User, socketio
+from app import app, db, User, socketio, _ping_buffer, _verified_passwords, \
+    check_password, parse_password_hash, run_background_pass, SWEEP_INTERVAL
 
 
 class UserTests(FlackTestCase):
+    @classmethod
+    def setUpClass(cls):
+        # the tables are created once, and emptied after each test
+        with app.app_context():
+            db.drop_all()  # just in case
+            db.create_all()
+
+    @classmethod
+    def tearDownClass(cls):
+        with app.app_context():
+            db.drop_all()
+
     def setUp(self):
         self.ctx = app.app_context()
         self.ctx.push()
-        db.drop_all()  # just in case
-        db.create_all()
         self.client = app.test_client()
 
     def tearDown(self):
-        db.drop_all()
+        db.session.rollback()
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+        # user ids are reused by the next test, so in-memory state that
+        # refers to users needs to be reset as well
+        _ping_buffer.clear()
+        _verified_passwords.clear()
+        parse_password_hash.cache_clear()
         self.ctx.pop()
 
     def test_user(self):
@@ -90,20 +111,34 @@ class UserTests(FlackTestCase):
         r, s, h = self.get('/api/users')
         self.assertEqual(s, 200)
         self.assertEqual(len(r['users']), 2)
+        for user in r['users']:
+            self.assertEqual(user['_links']['self'],
+                             '/api/users/{}'.format(user['id']))
 
     def test_user_online_offline(self):
-        # create a couple of users and a token
-        r, s, h = self.post('/api/users', data={'nickname': 'foo',
-                                                'password': 'foo'})
-        self.assertEqual(s, 201)
-        r, s, h = self.post('/api/users', data={'nickname': 'bar',
-                                                'password': 'bar'})
-        self.assertEqual(s, 201)
+        # create a couple of users a while ago, as pings are only recorded
+        # when they are newer than the last seen time
+        with mock.patch('app.time.time', return_value=time.time() - 10):
+            r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                    'password': 'foo'})
+            self.assertEqual(s, 201)
+            r, s, h = self.post('/api/users', data={'nickname': 'bar',
+                                                    'password': 'bar'})
+            self.assertEqual(s, 201)
+
+        # log in and get a token
         r, s, h = self.get('/api/users/me', basic_auth='foo:foo')
         self.assertEqual(s, 200)
+        r, s, h = self.get('/api/users/me', basic_auth='foo:foo')
+        self.assertEqual(s, 200)
+        r, s, h = self.get('/api/users/me', basic_auth='foo:bar')
+        self.assertEqual(s, 401)
+        r, s, h = self.get('/api/users/me')
+        self.assertEqual(s, 401)
         token = generate_token(1)
 
         # update online status
+        User.flush_pings()
         User.find_offline_users()
 
         # get list of offline users
@@ -118,7 +153,9 @@ class UserTests(FlackTestCase):
         self.assertEqual(len(r['users']), 1)
         self.assertEqual(r['users'][0]['nickname'], 'foo')
 
-        # alter last seen time of the two users
+        # alter last seen time of the two users, discarding the pings from
+        # the requests above so that they do not bring the users back
+        _ping_buffer.clear()
         user = User.query.filter_by(nickname='foo').first()
         user.last_seen_at = int(time.time()) - 65
         db.session.add(user)
@@ -128,6 +165,24 @@ class UserTests(FlackTestCase):
         db.session.commit()
 
         # update online status
+        User.flush_pings()
+        User.find_offline_users()
+
+        # both users are now offline, and clients were notified about foo
+        self.assertEqual(socketio.emit.call_args[0][0], 'updated_model')
+        self.assertEqual(socketio.emit.call_args[0][1]['model']['nickname'],
+                         'foo')
+        self.assertFalse(socketio.emit.call_args[0][1]['model']['online'])
+        r, s, h = self.get('/api/users?online=0')
+        self.assertEqual(s, 200)
+        self.assertEqual(len(r['users']), 2)
+
+        # a request with a token brings its owner back online once the
+        # buffered ping is written
+        r, s, h = self.get('/api/users?online=1', token_auth=token)
+        self.assertEqual(s, 200)
+        self.assertEqual(len(r['users']), 0)
+        User.flush_pings()
         User.find_offline_users()
 
         # get list of offline users
@@ -145,6 +200,8 @@ class UserTests(FlackTestCase):
         # get users updated since a timestamp
         since = r['users'][0]['updated_at']
         with mock.patch('app.time.time', return_value=since + 10):
+            r, s, h = self.get('/api/users', token_auth=token)
+            User.flush_pings()
             r, s, h = self.get('/api/users?updated_since=' + str(since + 2),
                                token_auth=token)
         self.assertEqual(s, 200)
@@ -178,6 +235,118 @@ class UserTests(FlackTestCase):
         user = User.query.filter_by(nickname='foo').first()
         self.assertTrue(user.online)
 
+    def test_flush_pings(self):
+        r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                'password': 'foo'})
+        self.assertEqual(s, 201)
+        r, s, h = self.post('/api/users', data={'nickname': 'bar',
+                                                'password': 'bar'})
+        self.assertEqual(s, 201)
+
+        # each user gets its own last seen time, unknown users are ignored
+        now = int(time.time())
+        _ping_buffer.clear()
+        _ping_buffer.update({1: now + 10, 2: now + 20, 99: now + 30})
+        User.flush_pings()
+        self.assertEqual(_ping_buffer, {})
+        r, s, h = self.get('/api/users')
+        self.assertEqual(s, 200)
+        users = {user['id']: user for user in r['users']}
+        self.assertEqual(sorted(users.keys()), [1, 2])
+        self.assertEqual(users[1]['last_seen_at'], now + 10)
+        self.assertTrue(users[1]['online'])
+        self.assertEqual(users[2]['last_seen_at'], now + 20)
+        self.assertTrue(users[2]['online'])
+
+    def test_flush_pings_error(self):
+        r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                'password': 'foo'})
+        self.assertEqual(s, 201)
+        now = int(time.time())
+        _ping_buffer.clear()
+        _ping_buffer[1] = now + 10
+
+        # pings are kept when they cannot be written
+        with mock.patch.object(db.session, 'commit',
+                               side_effect=RuntimeError):
+            self.assertRaises(RuntimeError, User.flush_pings)
+        db.session.rollback()
+        self.assertEqual(_ping_buffer, {1: now + 10})
+
+        # newer pings recorded during a failed write are not overwritten
+        def commit():
+            _ping_buffer[1] = now + 20
+            raise RuntimeError()
+
+        with mock.patch.object(db.session, 'commit', side_effect=commit):
+            self.assertRaises(RuntimeError, User.flush_pings)
+        db.session.rollback()
+        self.assertEqual(_ping_buffer, {1: now + 20})
+
+        # the pings are written on the next attempt
+        User.flush_pings()
+        self.assertEqual(_ping_buffer, {})
+        user = User.query.populate_existing().get(1)
+        self.assertEqual(user.last_seen_at, now + 20)
+        self.assertTrue(user.online)
+
+    def test_logout_discards_older_pings(self):
+        r, s, h = self.post('/api/users', data={'nickname': 'foo',
+                                                'password': 'foo'})
+        self.assertEqual(s, 201)
+        token = generate_token(1)
+        now = int(time.time())
+        user = User.query.get(1)
+        user.last_seen_at = now - 30
+        user.online = True
+        db.session.commit()
+
+        # log out, then flush a ping recorded before the logout, as another
+        # process would do
+        r, s, h = self.delete('/api/users/me', token_auth=token)
+        self.assertEqual(s, 204)
+        _ping_buffer[1] = now - 5
+        User.flush_pings()
+        user = User.query.populate_existing().get(1)
+        self.assertFalse(user.online)
+        self.assertGreaterEqual(user.last_seen_at, now)
+
+    def test_sweep_lock(self):
+        with mock.patch('app.lock_client') as lock_client, \
+                mock.patch.object(User, 'find_offline_users') as sweep:
+            # another process holds the lock
+            lock_client.set.return_value = None
+            run_background_pass()
+            lock_client.set.assert_called_once_with(
+                'microflack_users:sweep', os.getpid(), nx=True,
+                px=SWEEP_INTERVAL * 1000 - 500)
+            sweep.assert_not_called()
+
+            # this process gets the lock
+            lock_client.set.return_value = True
+            run_background_pass()
+            sweep.assert_called_once_with()
+
+    def test_check_password(self):
+        hashes = [generate_password_hash('foo', method='pbkdf2:sha256:1000'),
+                  generate_password_hash('foo', method='pbkdf2:sha256'),
+                  generate_password_hash('foo', method='sha256'),
+                  'pbkdf2:sha256:1000$malformed']
+        for password_hash in hashes:
+            for password in ['foo', 'bar']:
+                self.assertEqual(check_password(password_hash, password),
+                                 check_password_hash(password_hash, password))
+        self.assertTrue(check_password(hashes[0], 'foo'))
+        self.assertTrue(check_password(hashes[1], 'foo'))
+        self.assertTrue(check_password(hashes[2], 'foo'))
+        self.assertFalse(check_password(hashes[3], 'foo'))
+
+        # only PBKDF2 hashes are verified without Werkzeug
+        self.assertIsNotNone(parse_password_hash(hashes[0]))
+        self.assertIsNotNone(parse_password_hash(hashes[1]))
+        self.assertIsNone(parse_password_hash(hashes[2]))
+        self.assertIsNone(parse_password_hash(hashes[3]))
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)